@@ -7,9 +7,17 @@ Fixed Version - Commands will work now
 import os
 import sys
 import logging
+import signal
 import asyncio
+import codecs
+import heapq
+import itertools
 import time
+import uuid
+from collections import OrderedDict, deque
 import sqlite3
+from contextlib import aclosing, contextmanager, nullcontext
+from functools import lru_cache
 from pathlib import Path
 from threading import Thread
 from datetime import datetime
@@ -17,6 +25,7 @@ from urllib.parse import urlparse, urljoin
 
 # Third party imports
 from telegram import Update, InputFile
+from telegram.constants import MessageLimit, ParseMode
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -24,12 +33,15 @@ from telegram.ext import (
     filters,
     ContextTypes
 )
-import requests
-from bs4 import BeautifulSoup
+import httpx
+import aiofiles
+import lxml.html
+import orjson
 from dotenv import load_dotenv
-from apscheduler.schedulers.background import BackgroundScheduler
-from flask import Flask, request, jsonify
-import threading
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from fastapi import FastAPI, Request
+from fastapi.responses import ORJSONResponse
+import uvicorn
 
 # Load environment variables
 load_dotenv()
@@ -57,22 +69,31 @@ class Config:
     # Bot Settings
     AUTO_DELETE_TIME = 10
     MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB (Telegram limit for bots)
+    TEMP_CLEANUP_INTERVAL = int(os.environ.get('TEMP_CLEANUP_INTERVAL', 3600))
+    IN_MEMORY_DOWNLOAD_LIMIT = 5 * 1024 * 1024  # Smaller files skip the temp dir
+    SHUTDOWN_GRACE_PERIOD = 20  # Seconds a running check gets to finish on shutdown
+    
+    # Website check concurrency
+    SITE_CONCURRENCY = 10  # Websites checked at the same time
+    DOWNLOADS_PER_SITE = 3  # Downloads fetched ahead within one website
+    SENDS_PER_SECOND = 0.5  # Per chat, keeps well under Telegram flood limits
     
     # Paths
     BASE_DIR = Path(__file__).parent
     DATA_DIR = BASE_DIR / 'data'
     TEMP_DIR = BASE_DIR / 'temp_files'
     
-    # Create directories
-    DATA_DIR.mkdir(exist_ok=True)
-    TEMP_DIR.mkdir(exist_ok=True)
-    
     # Database path
     DB_PATH = DATA_DIR / 'bot_database.db'
     
     # Logging directory
     LOG_DIR = BASE_DIR / 'logs'
-    LOG_DIR.mkdir(exist_ok=True)
+    
+    @classmethod
+    def ensure_directories(cls):
+        """Create data, temp and log directories (called once from main)"""
+        for path in (cls.DATA_DIR, cls.TEMP_DIR, cls.LOG_DIR):
+            os.makedirs(path, exist_ok=True)
 
 # Initialize config
 config = Config()
@@ -82,7 +103,8 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO,
     handlers=[
-        logging.FileHandler(config.LOG_DIR / 'bot.log'),
+        # Opened on first record, after main() has created LOG_DIR
+        logging.FileHandler(config.LOG_DIR / 'bot.log', delay=True),
         logging.StreamHandler(sys.stdout)
     ]
 )
@@ -90,49 +112,225 @@ logger = logging.getLogger(__name__)
 
 # =================== DATABASE ===================
 class Database:
+    # Writer batching limits
+    WRITE_BATCH_SIZE = 128
+    WRITE_BATCH_DELAY = 0.05  # Seconds to wait for more writes before committing
+    
     def __init__(self):
-        self.conn = sqlite3.connect(config.DB_PATH, check_same_thread=False)
+        # Reads and schema setup use this connection on the event loop
+        self.conn = self.connect()
         self.cursor = self.conn.cursor()
+        logger.info(f"SQLite journal mode: {self.cursor.execute('PRAGMA journal_mode').fetchone()[0]}")
         self.init_tables()
+        
+        # Writes go through a queue to a second connection (see start_writer)
+        self.write_conn = None
+        self.write_queue = None
+        self.writer_task = None
+    
+    def connect(self):
+        """Open a connection with the bot's PRAGMAs applied"""
+        # Autocommit mode: writes open their own BEGIN IMMEDIATE transaction
+        conn = sqlite3.connect(
+            config.DB_PATH,
+            check_same_thread=False,
+            isolation_level=None
+        )
+        # Rows support access by column name
+        conn.row_factory = sqlite3.Row
+        
+        # WAL so readers don't block writers
+        conn.execute('PRAGMA journal_mode=WAL')
+        
+        # Checkpoint every 1000 pages (~4MB) so the -wal file stays small
+        conn.execute('PRAGMA wal_autocheckpoint=1000')
+        
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-20000')
+        # Memory-map up to 256MB so page reads skip read() syscalls
+        conn.execute('PRAGMA mmap_size=268435456')
+        return conn
+    
+    @contextmanager
+    def transaction(self, mode='IMMEDIATE'):
+        """Run statements inside an explicit BEGIN transaction"""
+        self.cursor.execute(f'BEGIN {mode}')
+        try:
+            yield self.cursor
+        except Exception:
+            self.cursor.execute('ROLLBACK')
+            raise
+        self.cursor.execute('COMMIT')
     
     def init_tables(self):
         """Initialize database tables"""
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS websites (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                url TEXT UNIQUE NOT NULL,
-                name TEXT,
-                chat_id TEXT,
-                folder TEXT,
-                file_types TEXT,
-                last_checked DATETIME,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        with self.transaction():
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS websites (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    url TEXT UNIQUE NOT NULL,
+                    name TEXT,
+                    chat_id TEXT,
+                    folder TEXT,
+                    file_types TEXT,
+                    last_checked DATETIME,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS downloaded_files (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    website_id INTEGER,
+                    file_url TEXT UNIQUE,
+                    file_name TEXT,
+                    file_size INTEGER,
+                    sent_to_user BOOLEAN DEFAULT 0,
+                    downloaded_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+    
+    async def start_writer(self):
+        """Start the batching writer task on the running event loop"""
+        if self.writer_task:
+            return
         
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS downloaded_files (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                website_id INTEGER,
-                file_url TEXT UNIQUE,
-                file_name TEXT,
-                file_size INTEGER,
-                sent_to_user BOOLEAN DEFAULT 0,
-                downloaded_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        self.write_conn = self.connect()
+        self.write_queue = asyncio.Queue()
+        self.writer_task = asyncio.create_task(self._writer_loop())
+    
+    async def stop_writer(self):
+        """Flush queued writes and stop the writer task"""
+        if not self.writer_task:
+            return
+        
+        await self.write_queue.put(None)
+        await self.writer_task
+        self.writer_task = None
+        
+        # Refresh planner statistics where they are stale; cheap, unlike a
+        # full ANALYZE, and what SQLite recommends before closing
+        try:
+            await asyncio.to_thread(
+                lambda: self.write_conn.execute('PRAGMA optimize').fetchall()
             )
-        ''')
+        except sqlite3.Error as e:
+            logger.error(f"Database error during optimize: {e}")
+        self.write_conn.close()
+    
+    async def write(self, sql, params=(), many=False):
+        """Queue a write and wait until its batch is committed"""
+        future = asyncio.get_running_loop().create_future()
+        await self.write_queue.put((sql, params, many, future))
+        return await future
+    
+    async def run_in_writer(self, func):
+        """Queue func(write_conn) to run between batches, outside any transaction
         
-        self.conn.commit()
+        func must read any rows it queries and return plain values, not a cursor.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.write_queue.put((func, future))
+        return await future
     
-    def add_website(self, url, name, chat_id, folder, file_types):
+    async def _writer_loop(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        
+        while not stopping:
+            item = await self.write_queue.get()
+            if item is None:
+                break
+            batch = []
+            jobs = []  # run_in_writer calls, run after the batch commits
+            (jobs if len(item) == 2 else batch).append(item)
+            
+            # Collect more writes for a short while so they share one commit
+            deadline = loop.time() + self.WRITE_BATCH_DELAY
+            while len(batch) < self.WRITE_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.write_queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                (jobs if len(item) == 2 else batch).append(item)
+            
+            # Commit (and fsync) in a worker thread, off the event loop
+            if batch:
+                try:
+                    results = await asyncio.to_thread(self._apply_batch, batch)
+                except Exception as e:
+                    results = [e] * len(batch)
+                
+                for (_, _, _, future), result in zip(batch, results):
+                    if future.done():
+                        continue
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+            
+            for func, future in jobs:
+                try:
+                    result = await asyncio.to_thread(func, self.write_conn)
+                except Exception as e:
+                    result = e
+                
+                if not future.done():
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+                
+                # Hold nothing a job returned: an unread cursor left alive
+                # on write_conn would make the next batch's SAVEPOINT fail
+                del func, future, result
+            jobs.clear()
+    
+    def _apply_batch(self, batch):
+        """Run queued writes in one transaction; returns rowcount or error per write"""
+        cursor = self.write_conn.cursor()
+        results = []
+        
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            for sql, params, many, _ in batch:
+                # A savepoint per write keeps one failing statement from
+                # rolling back the rest of the batch
+                cursor.execute('SAVEPOINT queued_write')
+                try:
+                    if many:
+                        cursor.executemany(sql, params)
+                    else:
+                        cursor.execute(sql, params)
+                    results.append(cursor.rowcount)
+                except sqlite3.Error as e:
+                    cursor.execute('ROLLBACK TO queued_write')
+                    results.append(e)
+                cursor.execute('RELEASE queued_write')
+            cursor.execute('COMMIT')
+        except Exception:
+            if self.write_conn.in_transaction:
+                cursor.execute('ROLLBACK')
+            raise
+        
+        return results
+    
+    async def add_website(self, url, name, chat_id, folder, file_types):
         """Add a new website to monitor"""
         try:
-            self.cursor.execute('''
+            await self.write('''
                 INSERT OR REPLACE INTO websites 
                 (url, name, chat_id, folder, file_types)
                 VALUES (?, ?, ?, ?, ?)
             ''', (url, name, str(chat_id), folder, file_types))
-            self.conn.commit()
             return True
         except Exception as e:
             logger.error(f"Database error adding website: {e}")
@@ -143,102 +341,191 @@ class Database:
         self.cursor.execute('SELECT * FROM websites')
         return self.cursor.fetchall()
     
-    def get_website_by_url(self, url):
-        """Get website by URL"""
-        self.cursor.execute('SELECT * FROM websites WHERE url = ?', (url,))
-        return self.cursor.fetchone()
-    
-    def delete_website(self, url):
+    async def delete_website(self, url):
         """Delete website"""
         try:
-            self.cursor.execute('DELETE FROM websites WHERE url = ?', (url,))
-            self.conn.commit()
+            await self.write('DELETE FROM websites WHERE url = ?', (url,))
             return True
         except Exception as e:
             logger.error(f"Database error deleting website: {e}")
             return False
     
-    def mark_file_downloaded(self, website_id, file_url, file_name, file_size, sent=False):
+    async def mark_file_downloaded(self, website_id, file_url, file_name, file_size, sent=False):
         """Mark a file as downloaded"""
         try:
-            self.cursor.execute('''
+            await self.write('''
                 INSERT OR IGNORE INTO downloaded_files 
                 (website_id, file_url, file_name, file_size, sent_to_user)
                 VALUES (?, ?, ?, ?, ?)
             ''', (website_id, file_url, file_name, file_size, sent))
-            self.conn.commit()
             return True
         except Exception as e:
             logger.error(f"Database error marking file: {e}")
             return False
     
-    def is_file_downloaded(self, file_url):
-        """Check if file already downloaded"""
-        self.cursor.execute(
-            'SELECT 1 FROM downloaded_files WHERE file_url = ?',
-            (file_url,)
-        )
-        return self.cursor.fetchone() is not None
+    def filter_new_urls(self, urls):
+        """Return the set of urls not yet in downloaded_files
+        
+        The urls go into a temp table and are resolved with one anti-join
+        on the file_url index instead of one lookup per URL. Only the temp
+        table is written, so a deferred transaction never blocks the writer.
+        """
+        with self.transaction('DEFERRED'):
+            self.cursor.execute(
+                'CREATE TEMP TABLE IF NOT EXISTS scraped_urls (url TEXT PRIMARY KEY)'
+            )
+            self.cursor.execute('DELETE FROM scraped_urls')
+            self.cursor.executemany(
+                'INSERT OR IGNORE INTO scraped_urls (url) VALUES (?)',
+                ((url,) for url in urls)
+            )
+            self.cursor.execute('''
+                SELECT s.url FROM scraped_urls s
+                LEFT JOIN downloaded_files d ON d.file_url = s.url
+                WHERE d.id IS NULL
+            ''')
+            return {row[0] for row in self.cursor.fetchall()}
+    
+    async def touch_websites(self, website_ids):
+        """Update the last checked time of several websites at once"""
+        try:
+            await self.write(
+                'UPDATE websites SET last_checked = CURRENT_TIMESTAMP WHERE id = ?',
+                [(website_id,) for website_id in website_ids], many=True
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Database error updating website: {e}")
+            return False
     
-    def mark_file_sent(self, file_url):
-        """Mark file as sent to user"""
+    async def checkpoint(self):
+        """Copy the WAL into the database and truncate the -wal file
+        
+        Runs on the writer connection, so it never waits on a batch commit
+        and its fsync stays off the event loop.
+        """
         try:
-            self.cursor.execute(
-                'UPDATE downloaded_files SET sent_to_user = 1 WHERE file_url = ?',
-                (file_url,)
+            await self.run_in_writer(
+                lambda conn: conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
             )
-            self.conn.commit()
             return True
         except Exception as e:
-            logger.error(f"Database error marking file sent: {e}")
+            logger.error(f"Database error during checkpoint: {e}")
             return False
     
     def close(self):
         """Close database connection"""
         self.conn.close()
 
-# Initialize database
-db = Database()
+# Database instance (initialized in main)
+db = None
 
-# =================== FLASK WEB SERVER ===================
-app = Flask(__name__)
+def setup_database():
+    """Open the database and return it"""
+    global db
+    db = Database()
+    return db
 
-@app.route('/')
-def home():
-    return jsonify({
+# =================== WEB SERVER ===================
+# ASGI app served by uvicorn on the bot's own event loop
+# Responses are serialized with orjson instead of the stdlib json encoder
+app = FastAPI(default_response_class=ORJSONResponse)
+
+@app.get('/')
+async def home():
+    return {
         "status": "online",
         "service": "Telegram File Downloader Bot",
         "timestamp": datetime.now().isoformat(),
         "mode": "webhook" if config.IS_RENDER else "polling"
-    })
+    }
+
+@app.get('/health')
+async def health():
+    return {"status": "healthy"}
 
-@app.route('/health')
-def health():
-    return jsonify({"status": "healthy"})
+@app.post('/webhook')
+async def webhook(request: Request):
+    """Receive Telegram updates and queue them for the running application"""
+    # orjson parses the raw body in C, faster than the stdlib json behind request.json()
+    update = Update.de_json(orjson.loads(await request.body()), application.bot)
+    # Acknowledge right away; the application's own fetcher task
+    # dispatches the update, so slow handlers don't hold the request
+    await application.update_queue.put(update)
+    return {"ok": True}
 
 # =================== BOT HANDLERS ===================
 def is_owner(user_id):
     """Check if user is owner"""
     return user_id == config.OWNER_ID
 
-async def delete_message_after(message, seconds):
-    """Delete message after specified seconds"""
-    await asyncio.sleep(seconds)
-    try:
-        await message.delete()
-    except:
-        pass
+class MessageReaper:
+    """Delete messages after a delay from one background task"""
+    def __init__(self):
+        self.queue = []  # Heap of (delete_at, seq, message)
+        self.counter = itertools.count()
+        self.wakeup = None
+        self.task = None
+    
+    def schedule(self, message, seconds):
+        """Delete message after specified seconds (returns immediately)"""
+        heapq.heappush(self.queue, (time.monotonic() + seconds, next(self.counter), message))
+        if self.wakeup:
+            self.wakeup.set()
+    
+    def start(self):
+        """Start the reaper task on the running event loop"""
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Cancel the reaper task"""
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+    
+    async def _run(self):
+        while True:
+            # Delete everything that is due in one concurrent round; PTB 20.7
+            # has no delete_messages, so this is one API call per message
+            now = time.monotonic()
+            due = []
+            while self.queue and self.queue[0][0] <= now:
+                due.append(heapq.heappop(self.queue)[2])
+            if due:
+                await asyncio.gather(
+                    *(message.delete() for message in due),
+                    return_exceptions=True
+                )
+            
+            # Sleep until the earliest deadline or until something new is scheduled
+            self.wakeup.clear()
+            timeout = self.queue[0][0] - time.monotonic() if self.queue else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
 
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle /start command"""
-    user_id = update.effective_user.id
-    
-    if not is_owner(user_id):
-        msg = await update.message.reply_text("❌ Unauthorized access!")
-        await delete_message_after(msg, 5)
-        return
-    
-    welcome_text = """
+reaper = MessageReaper()
+
+# Shared reply options; legacy Markdown, since the texts aren't escaped for MarkdownV2
+REPLY_MD = {'parse_mode': ParseMode.MARKDOWN}
+
+# Message texts are built once; only /status fills in live values
+ADD_SITE_USAGE = (
+    "Usage: `/addsite <url> <file_types>`\n"
+    "Example: `/addsite https://example.com pdf,docx,mp4`"
+)
+DEL_SITE_USAGE = "Usage: `/delsite <url>`"
+DOWNLOAD_USAGE = (
+    "Usage: `/download <file_url>`\n"
+    "Example: `/download https://example.com/file.pdf`"
+)
+
+START_TEXT = """
 🤖 *File Downloader Bot*
 
 *मैं ये कर सकता हूं:*
@@ -257,14 +544,9 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 *Example:*
 `/addsite https://example.com/pdf pdf,docx`
 `/download https://example.com/file.pdf`
-    """
-    
-    await update.message.reply_text(welcome_text, parse_mode='Markdown')
-    logger.info(f"Start command received from {user_id}")
+"""
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle /help command"""
-    help_text = """
+HELP_TEXT = """
 📚 *File Downloader Bot Help*
 
 *How it works:*
@@ -284,9 +566,36 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 `/addsite https://filesamples.com pdf,docx`
 `/download https://www.w3.org/WAI/ER/tests/xhtml/testfiles/resources/pdf/dummy.pdf`
 `/listsites`
-    """
+"""
+
+STATUS_TMPL = """
+📊 *Bot Status*
+
+*Environment:* {environment}
+*Port:* `{port}`
+*Webhook:* `{webhook}`
+*Websites:* {websites}
+*Temp Files:* {temp_files}
+*Owner ID:* `{owner_id}`
+*Max File Size:* {max_size} MB
+*Mode:* {mode}
+"""
+
+async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /start command"""
+    user_id = update.effective_user.id
+    
+    if not is_owner(user_id):
+        msg = await update.message.reply_text("❌ Unauthorized access!")
+        reaper.schedule(msg, 5)
+        return
     
-    await update.message.reply_text(help_text, parse_mode='Markdown')
+    await update.message.reply_text(START_TEXT, **REPLY_MD)
+    logger.info(f"Start command received from {user_id}")
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /help command"""
+    await update.message.reply_text(HELP_TEXT, **REPLY_MD)
     logger.info(f"Help command received from {update.effective_user.id}")
 
 async def add_site_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -295,15 +604,11 @@ async def add_site_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if not is_owner(user_id):
         msg = await update.message.reply_text("❌ Unauthorized access!")
-        await delete_message_after(msg, 5)
+        reaper.schedule(msg, 5)
         return
     
     if len(context.args) < 2:
-        await update.message.reply_text(
-            "Usage: `/addsite <url> <file_types>`\n"
-            "Example: `/addsite https://example.com pdf,docx,mp4`",
-            parse_mode='Markdown'
-        )
+        await update.message.reply_text(ADD_SITE_USAGE, **REPLY_MD)
         return
     
     url = context.args[0]
@@ -318,7 +623,7 @@ async def add_site_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         name = url[:30]
     
     # Add to database
-    if db.add_website(url, name, chat_id, "downloads", file_types):
+    if await db.add_website(url, name, chat_id, "downloads", file_types):
         response = f"""
 ✅ *Website Added!*
 
@@ -332,7 +637,12 @@ Bot हर 30 minutes में automatic check करेगा और new files
     else:
         response = "❌ Failed to add website."
     
-    await update.message.reply_text(response, parse_mode='Markdown')
+    await update.message.reply_text(response, **REPLY_MD)
+
+def clip(text, limit=1000):
+    """Shorten text to at most limit characters"""
+    text = str(text)
+    return text if len(text) <= limit else text[:limit - 1] + '…'
 
 async def list_sites_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /listsites command"""
@@ -340,7 +650,7 @@ async def list_sites_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     if not is_owner(user_id):
         msg = await update.message.reply_text("❌ Unauthorized access!")
-        await delete_message_after(msg, 5)
+        reaper.schedule(msg, 5)
         return
     
     websites = db.get_websites()
@@ -349,14 +659,31 @@ async def list_sites_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("📭 No websites added yet.")
         return
     
-    response = "📋 *Your Websites:*\n\n"
+    # Group entries into messages under Telegram's text limit, joining
+    # each message once instead of growing one string with +=
+    messages = []
+    parts = ["📋 *Your Websites:*\n\n"]
+    length = len(parts[0])
+    has_entry = False
     for idx, site in enumerate(websites, 1):
-        response += f"*{idx}. {site[2]}*\n"
-        response += f"   URL: `{site[1]}`\n"
-        response += f"   Types: `{site[5]}`\n"
-        response += f"   Chat: `{site[3]}`\n\n"
-    
-    await update.message.reply_text(response, parse_mode='Markdown')
+        # Fields are clipped so one entry always fits in a message
+        entry = (
+            f"*{idx}. {clip(site['name'])}*\n"
+            f"   URL: `{clip(site['url'])}`\n"
+            f"   Types: `{clip(site['file_types'])}`\n"
+            f"   Chat: `{site['chat_id']}`\n\n"
+        )
+        if has_entry and length + len(entry) > MessageLimit.MAX_TEXT_LENGTH:
+            messages.append(''.join(parts))
+            parts, length = [], 0
+        parts.append(entry)
+        length += len(entry)
+        has_entry = True
+    messages.append(''.join(parts))
+    
+    # Sent in order; concurrent sends could arrive shuffled
+    for text in messages:
+        await update.message.reply_text(text, **REPLY_MD)
     logger.info(f"List sites command from {user_id}")
 
 async def delete_site_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -365,20 +692,20 @@ async def delete_site_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     if not is_owner(user_id):
         msg = await update.message.reply_text("❌ Unauthorized access!")
-        await delete_message_after(msg, 5)
+        reaper.schedule(msg, 5)
         return
     
     if not context.args:
-        await update.message.reply_text("Usage: `/delsite <url>`", parse_mode='Markdown')
+        await update.message.reply_text(DEL_SITE_USAGE, **REPLY_MD)
         return
     
     url = context.args[0]
     
-    if db.delete_website(url):
-        await update.message.reply_text(f"✅ Removed: `{url}`", parse_mode='Markdown')
+    if await db.delete_website(url):
+        await update.message.reply_text(f"✅ Removed: `{url}`", **REPLY_MD)
         logger.info(f"Website deleted by {user_id}: {url}")
     else:
-        await update.message.reply_text(f"❌ Not found: `{url}`", parse_mode='Markdown')
+        await update.message.reply_text(f"❌ Not found: `{url}`", **REPLY_MD)
 
 async def download_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /download command - Direct file download"""
@@ -386,15 +713,11 @@ async def download_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if not is_owner(user_id):
         msg = await update.message.reply_text("❌ Unauthorized access!")
-        await delete_message_after(msg, 5)
+        reaper.schedule(msg, 5)
         return
     
     if not context.args:
-        await update.message.reply_text(
-            "Usage: `/download <file_url>`\n"
-            "Example: `/download https://example.com/file.pdf`",
-            parse_mode='Markdown'
-        )
+        await update.message.reply_text(DOWNLOAD_USAGE, **REPLY_MD)
         return
     
     file_url = context.args[0]
@@ -405,11 +728,13 @@ async def download_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         # Download file
-        downloaded = await download_file(file_url)
+        downloaded = await scanner.download_file(file_url)
         
-        if downloaded and downloaded['path'].exists():
+        if downloaded:
             # Send file to user
-            await send_file_to_user(chat_id, downloaded['path'], downloaded['name'])
+            await send_file_to_user(
+                chat_id, downloaded['file'], downloaded['name'], filename=downloaded['name']
+            )
             
             # Update message
             await msg.edit_text(
@@ -419,7 +744,8 @@ async def download_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             
             # Cleanup
-            downloaded['path'].unlink()
+            if downloaded['path']:
+                downloaded['path'].unlink()
             logger.info(f"File downloaded by {user_id}: {file_url}")
         else:
             await msg.edit_text("❌ Failed to download file.")
@@ -434,80 +760,40 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if not is_owner(user_id):
         msg = await update.message.reply_text("❌ Unauthorized access!")
-        await delete_message_after(msg, 5)
+        reaper.schedule(msg, 5)
         return
     
     websites = db.get_websites()
+    # DirEntry objects are cheaper than the Path objects glob() builds
+    with os.scandir(config.TEMP_DIR) as entries:
+        temp_count = sum(1 for _ in entries)
+    
+    status_text = STATUS_TMPL.format_map({
+        'environment': 'Render.com' if config.IS_RENDER else 'Local',
+        'port': config.PORT,
+        'webhook': config.WEBHOOK_URL if config.WEBHOOK_URL else 'Not set',
+        'websites': len(websites),
+        'temp_files': temp_count,
+        'owner_id': config.OWNER_ID,
+        'max_size': config.MAX_FILE_SIZE // 1024 // 1024,
+        'mode': 'Webhook (Render)' if config.IS_RENDER else 'Polling'
+    })
     
-    status_text = f"""
-📊 *Bot Status*
-
-*Environment:* {'Render.com' if config.IS_RENDER else 'Local'}
-*Port:* `{config.PORT}`
-*Webhook:* `{config.WEBHOOK_URL if config.WEBHOOK_URL else 'Not set'}`
-*Websites:* {len(websites)}
-*Temp Files:* {len(list(config.TEMP_DIR.glob('*')))}
-*Owner ID:* `{config.OWNER_ID}`
-*Max File Size:* {config.MAX_FILE_SIZE // 1024 // 1024} MB
-*Mode:* {'Webhook (Render)' if config.IS_RENDER else 'Polling'}
-    """
-    
-    await update.message.reply_text(status_text, parse_mode='Markdown')
+    await update.message.reply_text(status_text, **REPLY_MD)
     logger.info(f"Status command from {user_id}")
 
 # =================== FILE DOWNLOAD FUNCTIONS ===================
-async def download_file(file_url):
-    """Download a file from URL"""
-    try:
-        # Get filename from URL
-        filename = file_url.split('/')[-1]
-        if '?' in filename:
-            filename = filename.split('?')[0]
-        
-        if not filename:
-            filename = f"file_{int(time.time())}.bin"
-        
-        temp_path = config.TEMP_DIR / filename
-        
-        # Download file
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        }
-        
-        response = requests.get(file_url, headers=headers, stream=True, timeout=30)
-        response.raise_for_status()
-        
-        file_size = int(response.headers.get('content-length', 0))
-        
-        # Check file size limit
-        if file_size > config.MAX_FILE_SIZE:
-            logger.warning(f"File too large: {file_size} bytes")
-            return None
-        
-        # Download with progress
-        downloaded = 0
-        with open(temp_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-                    downloaded += len(chunk)
-        
-        return {
-            'path': temp_path,
-            'name': filename,
-            'size': file_size,
-            'url': file_url
-        }
-        
-    except Exception as e:
-        logger.error(f"Download error for {file_url}: {e}")
-        return None
-
-async def send_file_to_user(chat_id, file_path, caption=""):
-    """Send file to Telegram user"""
+async def send_file_to_user(chat_id, file, caption="", filename=None):
+    """Send file to Telegram user
+    
+    file: a Path on disk, or the file's bytes (filename required)
+    """
+    on_disk = isinstance(file, Path)
+    filename = filename or file.name
+    
     try:
         # Check file size (Telegram limits)
-        file_size = file_path.stat().st_size
+        file_size = file.stat().st_size if on_disk else len(file)
         
         if file_size > config.MAX_FILE_SIZE:
             # Send message instead
@@ -518,157 +804,491 @@ async def send_file_to_user(chat_id, file_path, caption=""):
             return False
         
         # Determine file type
-        ext = file_path.suffix.lower()
+        ext = Path(filename).suffix.lower()
         
-        with open(file_path, 'rb') as file:
-            if ext in ['.jpg', '.jpeg', '.png', '.gif']:
-                await application.bot.send_photo(
-                    chat_id=chat_id,
-                    photo=file,
-                    caption=caption[:1024]
-                )
-            elif ext in ['.mp4', '.avi', '.mkv', '.mov']:
-                await application.bot.send_video(
-                    chat_id=chat_id,
-                    video=file,
-                    caption=caption[:1024],
-                    supports_streaming=True
-                )
-            elif ext in ['.mp3', '.wav', '.ogg']:
-                await application.bot.send_audio(
-                    chat_id=chat_id,
-                    audio=file,
-                    caption=caption[:1024]
-                )
-            else:
-                await application.bot.send_document(
-                    chat_id=chat_id,
-                    document=file,
-                    caption=caption[:1024]
-                )
+        # PTB 20 buffers the whole upload anyway; read it without blocking
+        # the loop and hand over the bytes so they aren't copied again
+        if on_disk:
+            async with aiofiles.open(file, 'rb') as f:
+                file_data = await f.read()
+        else:
+            file_data = file
         
-        logger.info(f"File sent to {chat_id}: {file_path.name}")
+        if ext in ['.jpg', '.jpeg', '.png', '.gif']:
+            await application.bot.send_photo(
+                chat_id=chat_id,
+                photo=file_data,
+                filename=filename,
+                caption=caption[:1024]
+            )
+        elif ext in ['.mp4', '.avi', '.mkv', '.mov']:
+            await application.bot.send_video(
+                chat_id=chat_id,
+                video=file_data,
+                filename=filename,
+                caption=caption[:1024],
+                supports_streaming=True
+            )
+        elif ext in ['.mp3', '.wav', '.ogg']:
+            await application.bot.send_audio(
+                chat_id=chat_id,
+                audio=file_data,
+                filename=filename,
+                caption=caption[:1024]
+            )
+        else:
+            await application.bot.send_document(
+                chat_id=chat_id,
+                document=file_data,
+                filename=filename,
+                caption=caption[:1024]
+            )
+        
+        logger.info(f"File sent to {chat_id}: {filename}")
         return True
         
     except Exception as e:
         logger.error(f"Error sending file: {e}")
         return False
 
+@lru_cache(maxsize=256)
+def parse_file_types(file_types):
+    """Turn a 'pdf, MP4' setting into a ('.pdf', '.mp4') suffix tuple"""
+    return tuple(
+        '.' + ext.strip().lstrip('.').lower()
+        for ext in file_types.split(',')
+        if ext.strip()
+    )
+
+# Downloads with these suffixes are expected to be served as text/html
+HTML_EXTENSIONS = ('.html', '.htm', '.xhtml')
+
 class WebsiteScanner:
     """Scan website for downloadable files"""
+    # Pages whose validators are kept; least recently checked go first
+    PAGE_CACHE_SIZE = 256
+    
     def __init__(self):
-        self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        })
+        # Pooled client shared by every check, /download and keep-alive ping;
+        # the transport retries failed connection attempts
+        self.client = httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,
+                limits=httpx.Limits(
+                    max_connections=100,
+                    max_keepalive_connections=20,
+                    keepalive_expiry=60
+                ),
+                retries=3
+            ),
+            timeout=httpx.Timeout(30.0, connect=10.0),
+            headers={
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+            },
+            follow_redirects=True
+        )
+        
+        # (url, extensions) -> (validator headers, files) from the last full
+        # fetch, so unchanged pages can be answered with a 304. Bounded, so
+        # deleted sites and old file_types settings age out
+        self.page_cache = OrderedDict()
+    
+    async def close(self):
+        """Close pooled HTTP connections"""
+        await self.client.aclose()
     
-    def find_files_on_page(self, url, file_extensions):
-        """Find all files with given extensions on a webpage"""
+    async def find_files_on_page(self, url, extensions):
+        """Find all files with given extensions on a webpage
+        
+        extensions: suffix tuple from parse_file_types
+        """
+        key = (url, extensions)
         try:
-            response = self.session.get(url, timeout=30)
+            # Conditional GET: an unchanged page costs no body and no parse
+            cached = self.page_cache.get(key)
+            response = await self.client.get(url, headers=cached[0] if cached else None)
+            if cached and response.status_code == 304:
+                self.page_cache.move_to_end(key)
+                return cached[1]
             response.raise_for_status()
             
-            soup = BeautifulSoup(response.text, 'html.parser')
-            files = []
+            # Parsing is CPU-bound; run it in a worker thread so the event
+            # loop keeps serving Telegram updates during large scans
+            files = await asyncio.to_thread(
+                self.extract_files,
+                response.content,
+                response.charset_encoding,
+                url,
+                extensions
+            )
             
-            # Look for all links
-            for link in soup.find_all('a', href=True):
-                href = link['href']
-                full_url = urljoin(url, href)
-                
-                # Check if it's a file
-                for ext in file_extensions:
-                    if full_url.lower().endswith(f'.{ext}'):
-                        files.append({
-                            'url': full_url,
-                            'name': link.text.strip() or href.split('/')[-1],
-                            'type': ext
-                        })
-                        break
+            validators = {}
+            if 'etag' in response.headers:
+                validators['If-None-Match'] = response.headers['etag']
+            if 'last-modified' in response.headers:
+                validators['If-Modified-Since'] = response.headers['last-modified']
+            if validators:
+                self.page_cache[key] = (validators, files)
+                self.page_cache.move_to_end(key)
+                if len(self.page_cache) > self.PAGE_CACHE_SIZE:
+                    self.page_cache.popitem(last=False)
+            else:
+                self.page_cache.pop(key, None)
             
             return files
             
         except Exception as e:
             logger.error(f"Error scanning {url}: {e}")
             return []
+    
+    @staticmethod
+    def extract_files(content, encoding, url, extensions):
+        """Extract file links from raw HTML bytes (blocking)"""
+        # Parse raw bytes: lxml detects the encoding in C, skipping httpx's
+        # text decoding; a charset from the headers is used when given.
+        # libxml2 rejects some names Python accepts ('latin-1'), so pass
+        # Python's canonical name and let lxml detect anything unknown
+        try:
+            parser = lxml.html.HTMLParser(encoding=encoding and codecs.lookup(encoding).name)
+        except LookupError:
+            parser = lxml.html.HTMLParser()
+        doc = lxml.html.fromstring(content, parser=parser)
+        files = {}  # Keyed by URL so a file linked from several anchors is listed once
+        
+        # Relative links resolve against <base href> when the page sets one
+        base_url = url
+        base = doc.find('.//base[@href]')
+        if base is not None:
+            base_url = urljoin(url, base.get('href'))
+        
+        # Look for all anchor links
+        for element in doc.iter('a'):
+            href = element.get('href')
+            if not href:
+                continue
+            
+            # Check if it's a file (one endswith call tests every
+            # extension); resolving against the page URL keeps
+            # the href's suffix, so only matching links are joined.
+            # The query string and fragment don't count, so
+            # 'file.pdf?dl=1' is still a PDF
+            href = href.partition('#')[0]
+            path = href.partition('?')[0]
+            lower_path = path.lower()
+            if lower_path.endswith(extensions):
+                file_url = urljoin(base_url, href)
+                if file_url not in files:
+                    files[file_url] = {
+                        'url': file_url,
+                        'name': element.text_content().strip() or path.split('/')[-1],
+                        'type': lower_path.rsplit('.', 1)[-1]
+                    }
+        
+        return list(files.values())
+    
+    @staticmethod
+    def is_html(response):
+        """Check if a response is a web page rather than a file"""
+        content_type = response.headers.get('content-type', '')
+        return content_type.split(';')[0].strip().lower() in ('text/html', 'application/xhtml+xml')
+    
+    async def probe_file(self, file_url):
+        """Get a file's size and type without downloading it
+        
+        Returns (size, is_html); size is None if unknown
+        """
+        try:
+            response = await self.client.head(file_url)
+            
+            # HEAD not allowed: request one byte and read the total from Content-Range
+            if response.status_code in (405, 501):
+                headers = {'Range': 'bytes=0-0'}
+                async with self.client.stream('GET', file_url, headers=headers) as response:
+                    total = response.headers.get('content-range', '').rpartition('/')[2]
+                    return (int(total) if total.isdigit() else None), self.is_html(response)
+            
+            if not response.is_success:
+                return None, False
+            
+            size = response.headers.get('content-length', '')
+            return (int(size) if size.isdigit() else None), self.is_html(response)
+            
+        except httpx.HTTPError:
+            return None, False
+    
+    async def download_file(self, file_url):
+        """Download a file from URL"""
+        try:
+            # Get filename from URL
+            filename = file_url.split('/')[-1]
+            if '?' in filename:
+                filename = filename.split('?')[0]
+            
+            if not filename:
+                filename = f"file_{int(time.time())}.bin"
+            
+            # A web page is only the wanted file when an HTML file was asked for
+            reject_html = not filename.lower().endswith(HTML_EXTENSIONS)
+            
+            # Reject oversize files and error pages before any body bytes are transferred
+            remote_size, is_html = await self.probe_file(file_url)
+            if remote_size and remote_size > config.MAX_FILE_SIZE:
+                logger.warning(f"File too large: {remote_size} bytes")
+                return None
+            if is_html and reject_html:
+                logger.warning(f"Got a web page instead of a file: {file_url}")
+                return None
+            
+            # Small files of known size are kept in memory and never touch
+            # the disk; everything else is streamed to a temp file
+            in_memory = remote_size is not None and remote_size <= config.IN_MEMORY_DOWNLOAD_LIMIT
+            chunks = []
+            temp_path = None
+            if not in_memory:
+                # Unique prefix so concurrent downloads of equally named files don't collide
+                temp_path = config.TEMP_DIR / f"{uuid.uuid4().hex[:8]}_{filename}"
+            
+            async with self.client.stream('GET', file_url) as response:
+                response.raise_for_status()
+                
+                if reject_html and self.is_html(response):
+                    logger.warning(f"Got a web page instead of a file: {file_url}")
+                    return None
+                
+                file_size = int(response.headers.get('content-length', 0))
+                
+                # Check file size limit
+                if file_size > config.MAX_FILE_SIZE:
+                    logger.warning(f"File too large: {file_size} bytes")
+                    return None
+                
+                # Download with progress, enforcing the limit on actual bytes.
+                # 1 MiB chunks keep loop iterations and aiofiles thread hops
+                # low, and are large enough to bypass the file's write buffer
+                downloaded = 0
+                sink = nullcontext() if in_memory else aiofiles.open(temp_path, 'wb')
+                async with sink as f:
+                    async for chunk in response.aiter_bytes(1 << 20):
+                        downloaded += len(chunk)
+                        if downloaded > config.MAX_FILE_SIZE:
+                            break
+                        if in_memory:
+                            chunks.append(chunk)
+                        else:
+                            await f.write(chunk)
+            
+            if downloaded > config.MAX_FILE_SIZE:
+                logger.warning(f"File too large, aborted after {downloaded} bytes: {file_url}")
+                if temp_path:
+                    temp_path.unlink(missing_ok=True)
+                return None
+            
+            # 'file' is what to upload: the bytes, or the temp file path
+            return {
+                'file': b''.join(chunks) if in_memory else temp_path,
+                'path': temp_path,
+                'name': filename,
+                'size': downloaded,
+                'url': file_url
+            }
+            
+        except Exception as e:
+            logger.error(f"Download error for {file_url}: {e}")
+            return None
+
+class RateLimiter:
+    """Token bucket per key, so waiting on one chat doesn't block others"""
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.buckets = {}
+    
+    async def acquire(self, key):
+        """Wait until a token is available for key"""
+        while True:
+            now = time.monotonic()
+            tokens, updated = self.buckets.get(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+            
+            if tokens >= 1:
+                self.buckets[key] = (tokens - 1, now)
+                return
+            
+            self.buckets[key] = (tokens, now)
+            await asyncio.sleep((1 - tokens) / self.rate)
+
+# Paces file sends per chat
+send_limiter = RateLimiter(config.SENDS_PER_SECOND)
+
+# Shared scanner instance (initialized in main)
+scanner = None
+
+def setup_scanner():
+    """Create the shared scanner and return it"""
+    global scanner
+    scanner = WebsiteScanner()
+    return scanner
 
 async def check_websites():
     """Check all websites for new files and send them"""
+    global check_task
+    check_task = asyncio.current_task()
+    
     logger.info("Starting website check...")
     websites = db.get_websites()
     
     if not websites:
         return
     
-    scanner = WebsiteScanner()
+    semaphore = asyncio.Semaphore(config.SITE_CONCURRENCY)
+    
+    # URLs claimed during this crawl, shared by all sites so a file linked
+    # from several pages is only fetched once
+    seen = set()
+    
+    checked_ids = await asyncio.gather(
+        *(check_site(scanner, site, semaphore, seen) for site in websites),
+        return_exceptions=True
+    )
+    
+    # Update last checked time of every site that completed, in one write
+    checked_ids = [i for i in checked_ids if isinstance(i, int)]
+    if checked_ids:
+        await db.touch_websites(checked_ids)
+
+async def check_site(scanner, site, semaphore, seen):
+    """Check one website for new files and send them
     
-    for site in websites:
+    Returns the website id once checked, or None on failure.
+    """
+    async with semaphore:
         try:
-            website_id = site[0]
-            url = site[1]
-            chat_id = int(site[3])
-            file_types = site[5].split(',')
+            website_id = site['id']
+            url = site['url']
+            chat_id = int(site['chat_id'])
+            file_types = parse_file_types(site['file_types'])
             
             logger.info(f"Checking {url} for {file_types}")
             
             # Find files on website
-            files = scanner.find_files_on_page(url, file_types)
+            files = await scanner.find_files_on_page(url, file_types)
             
             if files:
                 logger.info(f"Found {len(files)} files on {url}")
                 
-                # Process each file
+                # Skip files already claimed by another site this run before touching SQLite
+                candidates = []
                 for file_info in files:
-                    # Check if already downloaded
-                    if not db.is_file_downloaded(file_info['url']):
-                        # Download file
-                        downloaded = await download_file(file_info['url'])
-                        
-                        if downloaded and downloaded['path'].exists():
-                            # Send to user
-                            sent = await send_file_to_user(chat_id, downloaded['path'], file_info['name'])
-                            
-                            # Mark in database
-                            db.mark_file_downloaded(
-                                website_id,
-                                file_info['url'],
-                                file_info['name'],
-                                downloaded['size'],
-                                sent
-                            )
-                            
-                            logger.info(f"Sent {file_info['name']} to {chat_id}")
-                            
-                            # Cleanup
-                            downloaded['path'].unlink()
-                            
-                            # Delay between files
-                            await asyncio.sleep(2)
-            
-            # Update last checked time
-            db.cursor.execute(
-                'UPDATE websites SET last_checked = CURRENT_TIMESTAMP WHERE id = ?',
-                (website_id,)
-            )
-            db.conn.commit()
+                    if file_info['url'] not in seen:
+                        seen.add(file_info['url'])
+                        candidates.append(file_info)
+                
+                # One anti-join finds the URLs never downloaded before
+                new_urls = db.filter_new_urls(f['url'] for f in candidates)
+                new_files = [f for f in candidates if f['url'] in new_urls]
+                
+                # Download a few files ahead, but send them in page order
+                async with aclosing(prefetch_downloads(scanner, new_files)) as downloads:
+                    async for file_info, downloaded in downloads:
+                        await send_site_file(website_id, chat_id, file_info, downloaded)
+            
+            return website_id
             
         except Exception as e:
             logger.error(f"Error processing website: {e}")
-            continue
+
+async def prefetch_downloads(scanner, files):
+    """Yield (file_info, download) pairs in the order of files
+    
+    Up to DOWNLOADS_PER_SITE downloads run ahead of the consumer, so the
+    next files are already fetched while the current one is being sent.
+    """
+    pending = deque()
+    files = iter(files)
+    
+    def fill():
+        while len(pending) < config.DOWNLOADS_PER_SITE:
+            file_info = next(files, None)
+            if file_info is None:
+                return
+            pending.append((file_info, asyncio.create_task(scanner.download_file(file_info['url']))))
+    
+    try:
+        fill()
+        while pending:
+            file_info, task = pending.popleft()
+            downloaded = await task
+            fill()
+            yield file_info, downloaded
+    finally:
+        # Stopped early (cancelled or an error): drop downloads nobody will send
+        for _, task in pending:
+            if not task.done():
+                task.cancel()
+            elif task.result() and task.result()['path']:
+                task.result()['path'].unlink(missing_ok=True)
+
+async def send_site_file(website_id, chat_id, file_info, downloaded):
+    """Send a downloaded file to the website's chat and record it
+    
+    Returns True once the file is recorded, False on failure.
+    """
+    try:
+        if downloaded:
+            # Send to user
+            await send_limiter.acquire(chat_id)
+            sent = await send_file_to_user(
+                chat_id, downloaded['file'], file_info['name'], filename=downloaded['name']
+            )
+            
+            logger.info(f"Sent {file_info['name']} to {chat_id}")
+            
+            # Cleanup
+            if downloaded['path']:
+                downloaded['path'].unlink()
+            
+            # Record it right away, so a restart mid-site doesn't resend it;
+            # the writer still commits rows queued close together as one batch
+            return await db.mark_file_downloaded(
+                website_id,
+                file_info['url'],
+                file_info['name'],
+                downloaded['size'],
+                sent
+            )
+            
+    except Exception as e:
+        logger.error(f"Error processing file {file_info['url']}: {e}")
+    
+    return False
 
 # =================== BACKGROUND TASKS ===================
+scheduler = None
+check_task = None  # Task of the latest check_websites run
+
 def start_background_scheduler():
-    """Start background scheduler"""
-    scheduler = BackgroundScheduler()
+    """Start background scheduler on the running event loop"""
+    global scheduler
+    
+    # Coroutine jobs are awaited on the bot's own loop
+    scheduler = AsyncIOScheduler()
     
     # Check websites every 30 minutes
     scheduler.add_job(
-        lambda: asyncio.run(check_websites()),
+        check_websites,
         'interval',
         minutes=30,
         id='website_check'
     )
     
+    # Remove stale temp files and truncate the WAL
+    scheduler.add_job(
+        cleanup_temp_files,
+        'interval',
+        seconds=config.TEMP_CLEANUP_INTERVAL,
+        id='temp_cleanup'
+    )
+    
     # Keep-alive ping for Render
     if config.IS_RENDER:
         scheduler.add_job(
@@ -681,12 +1301,67 @@ def start_background_scheduler():
     scheduler.start()
     logger.info("Background scheduler started")
 
-def keep_alive_ping():
+async def stop_background_scheduler():
+    """Stop background scheduler, letting a running website check finish
+    
+    Must complete before the writer stops and the scanner closes, or a
+    check still running would send files it can no longer record.
+    """
+    if not (scheduler and scheduler.running):
+        return
+    
+    # No new runs from here on
+    scheduler.pause()
+    
+    if check_task and not check_task.done():
+        logger.info("Waiting for the running website check to finish...")
+        done, _ = await asyncio.wait({check_task}, timeout=config.SHUTDOWN_GRACE_PERIOD)
+        if not done:
+            logger.warning("Website check still running, cancelling it")
+            # APScheduler logs a cancelled job as a crash with a full
+            # traceback; this cancel is deliberate and logged above
+            logging.getLogger('apscheduler.executors').setLevel(logging.CRITICAL)
+            check_task.cancel()
+            await asyncio.gather(check_task, return_exceptions=True)
+    
+    # Cancels whatever other jobs are still running
+    scheduler.shutdown(wait=False)
+
+def remove_stale_temp_files(cutoff):
+    """Delete temp files last modified before cutoff (blocking)"""
+    removed = 0
+    
+    # DirEntry caches the file type from readdir, and no Path objects are built
+    with os.scandir(config.TEMP_DIR) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file(follow_symlinks=False) and entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                    os.unlink(entry.path)
+                    removed += 1
+            except OSError as e:
+                logger.error(f"Error removing temp file {entry.path}: {e}")
+    
+    return removed
+
+async def cleanup_temp_files():
+    """Delete leftover temp files and checkpoint the database"""
+    cutoff = time.time() - config.TEMP_CLEANUP_INTERVAL
+    
+    # Directory scans and unlinks hit the disk; keep them off the event loop
+    removed = await asyncio.to_thread(remove_stale_temp_files, cutoff)
+    
+    if removed:
+        logger.info(f"Removed {removed} stale temp files")
+    
+    # Queued to the writer, which checkpoints (and fsyncs) in its own thread
+    await db.checkpoint()
+
+async def keep_alive_ping():
     """Ping own health endpoint"""
     try:
         if config.IS_RENDER and config.WEBHOOK_URL:
             health_url = config.WEBHOOK_URL.replace('/webhook', '/health')
-            response = requests.get(health_url, timeout=5)
+            response = await scanner.client.get(health_url, timeout=5)
             logger.debug(f"Keep-alive ping: {response.status_code}")
     except Exception as e:
         logger.error(f"Keep-alive ping failed: {e}")
@@ -717,15 +1392,17 @@ def setup_bot():
     logger.info("Bot handlers set up successfully")
     return application
 
-def run_flask():
-    """Run Flask server"""
-    logger.info(f"Starting Flask server on port {config.PORT}")
-    app.run(
+async def run_web_server():
+    """Serve the web app on the current event loop until shutdown"""
+    logger.info(f"Starting web server on port {config.PORT}")
+    server = uvicorn.Server(uvicorn.Config(
+        app,
         host='0.0.0.0',
         port=config.PORT,
-        debug=False,
-        use_reloader=False
-    )
+        loop='asyncio',
+        access_log=False  # Skip a log line for every webhook and keep-alive hit
+    ))
+    await server.serve()
 
 async def setup_webhook():
     """Setup webhook for Render"""
@@ -752,6 +1429,30 @@ async def setup_webhook():
         logger.error(f"Failed to set webhook: {e}")
         return False
 
+async def wait_for_shutdown():
+    """Block until SIGINT or SIGTERM, without waking the loop meanwhile"""
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    signals = (signal.SIGINT, signal.SIGTERM)
+    
+    # SIGTERM (what Render sends) would otherwise kill the process before
+    # the shutdown code below runs and flushes pending database writes
+    try:
+        for sig in signals:
+            loop.add_signal_handler(sig, stop.set)
+    except NotImplementedError:
+        # Windows: only Ctrl+C, which asyncio.run turns into cancellation
+        pass
+    
+    try:
+        await stop.wait()
+    finally:
+        for sig in signals:
+            try:
+                loop.remove_signal_handler(sig)
+            except NotImplementedError:
+                pass
+
 async def run_bot_polling():
     """Run bot in polling mode"""
     global application
@@ -762,12 +1463,31 @@ async def run_bot_polling():
     
     # Setup bot
     application = setup_bot()
+    await db.start_writer()
+    
+    # Start bot and polling on the current event loop
+    await application.initialize()
+    await application.start()
+    await application.updater.start_polling()
     
-    # Start background scheduler
+    # Start background scheduler and message reaper
     start_background_scheduler()
+    reaper.start()
     
-    # Run polling
-    await application.run_polling()
+    logger.info("Bot started in polling mode")
+    
+    # Run until the process is stopped
+    try:
+        await wait_for_shutdown()
+    finally:
+        logger.info("Bot stopping...")
+        await stop_background_scheduler()
+        await reaper.stop()
+        await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+        await db.stop_writer()
+        await scanner.close()
 
 async def run_bot_webhook():
     """Run bot in webhook mode (for Render)"""
@@ -780,9 +1500,7 @@ async def run_bot_webhook():
     
     # Setup bot
     application = setup_bot()
-    
-    # Start background scheduler
-    start_background_scheduler()
+    await db.start_writer()
     
     # Initialize application
     await application.initialize()
@@ -790,33 +1508,40 @@ async def run_bot_webhook():
     # Setup webhook
     if not await setup_webhook():
         logger.error("Failed to setup webhook, falling back to polling")
+        await application.shutdown()
         await run_bot_polling()
         return
     
     # Start application
     await application.start()
     
-    logger.info("Bot started in webhook mode")
-    
-    # Start Flask in a separate thread
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
+    # Start background scheduler and message reaper
+    start_background_scheduler()
+    reaper.start()
     
-    logger.info("Flask server started in background thread")
+    logger.info("Bot started in webhook mode")
     
-    # Keep the bot running
+    # Serve webhook and health routes until uvicorn receives a shutdown signal
     try:
-        while True:
-            await asyncio.sleep(3600)  # Sleep for 1 hour
-    except KeyboardInterrupt:
-        logger.info("Bot stopping...")
+        await run_web_server()
     finally:
+        logger.info("Bot stopping...")
+        await stop_background_scheduler()
+        await reaper.stop()
         await application.stop()
+        await application.shutdown()
+        await db.stop_writer()
+        await scanner.close()
 
 # =================== ENTRY POINT ===================
 def main():
     """Main entry point"""
     try:
+        # Create working directories, open the database and HTTP pool
+        config.ensure_directories()
+        setup_database()
+        setup_scanner()
+        
         # Check if BOT_TOKEN is set
         if not config.BOT_TOKEN:
             logger.error("❌ ERROR: BOT_TOKEN environment variable is not set!")